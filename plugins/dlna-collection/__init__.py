@@ -18,6 +18,7 @@
 
 
 
+import bisect
 import weakref
 
 import gi
@@ -26,6 +27,7 @@ gi.require_version('GUPnP', '1.2')
 gi.require_version('GUPnPAV', '1.0')
 gi.require_version('Gtk', '3.0')
 
+from gi.repository import GdkPixbuf
 from gi.repository import GLib
 from gi.repository import GObject
 from gi.repository import GUPnP
@@ -38,6 +40,7 @@ import xl.collection
 import xl.event
 import xl.trax
 import xl.providers
+import xl.settings
 
 import xlgui.panel.collection
 import xlgui.panel.menus
@@ -50,11 +53,174 @@ from gettext import gettext as _
 
 logger = logging.getLogger(__name__)
 
+class DlnaTrackIndex (object):
+    """Sorted artist/album/track index of a collection.
+
+    Artist and album nodes are keyed by (unknown, sort value, value)
+    tuples, and tracks by (disc number, track number, sort title,
+    location, label) tuples. The index can be updated one track at a
+    time; add() and remove() return the depth of the shallowest node
+    that was created or dropped, so that the caller can update only the
+    affected rows of a tree model."""
+
+    ARTIST, ALBUM, TRACK = range(3)
+
+    def __init__ (self, tracks=()):
+        self.__artists = []
+        self.__albums = {}
+        self.__tracks = {}
+        self.__entries = {}
+
+        # Bulk build; group first and sort once
+        for track in tracks:
+            location = track.get_loc_for_io()
+            if location in self.__entries:
+                continue
+
+            keys = self.get_keys(track)
+            (artist, album, entry) = keys
+
+            self.__albums.setdefault(artist, []).append(album)
+            self.__tracks.setdefault((artist, album), []).append(entry)
+            self.__entries[location] = keys
+
+        self.__artists = sorted(self.__albums)
+        for artist, albums in self.__albums.items():
+            self.__albums[artist] = sorted(set(albums))
+        for entries in self.__tracks.values():
+            entries.sort()
+
+    def __len__ (self):
+        return len(self.__entries)
+
+    def __contains__ (self, location):
+        return location in self.__entries
+
+    @staticmethod
+    def get_node_key (track, tag):
+        """Returns the artist/album node key of the track."""
+        value = track.get_tag_raw(tag)
+        if not value:
+            return (True, '', None) # Sort unknown entries last
+        return (False, track.get_tag_sort(tag), value[0])
+
+    @staticmethod
+    def get_number (track, tag):
+        """Returns the numeric value of a tag such as "3/12"."""
+        value = track.get_tag_raw(tag)
+        if not value:
+            return 0
+        try:
+            return int(value[0].split('/')[0])
+        except ValueError:
+            return 0
+
+    def get_keys (self, track):
+        """Returns the (artist, album, track) keys of the track."""
+        number = self.get_number(track, 'tracknumber')
+        title = track.get_tag_display('title')
+        if number:
+            title = '{0} - {1}'.format(number, title)
+
+        entry = (self.get_number(track, 'discnumber'), number, track.get_tag_sort('title') or '', track.get_loc_for_io(), title)
+
+        return (self.get_node_key(track, 'artist'), self.get_node_key(track, 'album'), entry)
+
+    def get_entry (self, location):
+        """Returns the indexed (artist, album, track) keys of a location."""
+        return self.__entries.get(location)
+
+    def get_path (self, keys):
+        """Returns the (artist, album, track) positions of indexed keys."""
+        (artist, album, entry) = keys
+        return (bisect.bisect_left(self.__artists, artist),
+                bisect.bisect_left(self.__albums[artist], album),
+                bisect.bisect_left(self.__tracks[(artist, album)], entry))
+
+    def get_artists (self):
+        return self.__artists
+
+    def get_albums (self, artist):
+        return self.__albums[artist]
+
+    def get_tracks (self, artist, album):
+        return self.__tracks[(artist, album)]
+
+    def get_locations (self, artist, album=None):
+        """Returns the sorted track locations under the given node."""
+        albums = self.__albums[artist] if album is None else [ album ]
+        return [entry[3] for album in albums for entry in self.__tracks[(artist, album)]]
+
+    def add (self, track):
+        """Adds a track; returns None if the track is already indexed."""
+        location = track.get_loc_for_io()
+        if location in self.__entries:
+            return None
+
+        keys = self.get_keys(track)
+        (artist, album, entry) = keys
+
+        depth = self.TRACK
+
+        albums = self.__albums.get(artist)
+        if albums is None:
+            albums = self.__albums[artist] = []
+            bisect.insort(self.__artists, artist)
+            depth = self.ARTIST
+
+        entries = self.__tracks.get((artist, album))
+        if entries is None:
+            entries = self.__tracks[(artist, album)] = []
+            bisect.insort(albums, album)
+            depth = min(depth, self.ALBUM)
+
+        bisect.insort(entries, entry)
+        self.__entries[location] = keys
+
+        return depth
+
+    def remove (self, location):
+        """Removes a track; returns None if the track is not indexed."""
+        keys = self.__entries.pop(location, None)
+        if keys is None:
+            return None
+
+        (artist, album, entry) = keys
+
+        entries = self.__tracks[(artist, album)]
+        del entries[bisect.bisect_left(entries, entry)]
+        if entries:
+            return self.TRACK
+
+        del self.__tracks[(artist, album)]
+        albums = self.__albums[artist]
+        del albums[bisect.bisect_left(albums, album)]
+        if albums:
+            return self.ALBUM
+
+        del self.__albums[artist]
+        del self.__artists[bisect.bisect_left(self.__artists, artist)]
+        return self.ARTIST
+
+
 class DlnaCollectionPanel (xlgui.panel.collection.CollectionPanel, GObject.GObject):
     __gsignals__ = {
         'disconnect-request': (GObject.SignalFlags.RUN_LAST, None, ())
     }
 
+    # Incremental mode: the tree is an artist/album/track view that is
+    # backed by DlnaTrackIndex and updated row-by-row from track
+    # add/remove deltas, with child rows populated on expansion. When
+    # a search keyword is entered or an order other than artist/album
+    # is selected, the panel falls back to the regular CollectionPanel
+    # tree. These are class attributes, because the base class loads
+    # the tree from within its constructor.
+    __stale = False
+    __index = None
+    __model = None
+    __full_model = None
+    __loaded = None
+
     def __init__ (self, parent, collection):
         xlgui.panel.collection.CollectionPanel.__init__(self, parent, collection, collection.udn, _show_collection_empty_message=False, label=collection.name)
         GObject.GObject.__init__(self)
@@ -79,6 +245,11 @@ class DlnaCollectionPanel (xlgui.panel.collection.CollectionPanel, GObject.GObje
         top_box.pack_end(button, False, False, 0)
         button.show()
 
+        # Keep the index up-to-date with the collection
+        xl.event.add_ui_callback(self.on_tracks_added, 'tracks_added', collection)
+        xl.event.add_ui_callback(self.on_tracks_removed, 'tracks_removed', collection)
+        xl.event.add_ui_callback(self.on_track_tags_changed, 'track_tags_changed')
+
     def on_refresh_button_press_event (self, button, event):
         """Override the referesh button action."""
         if event.get_state() & Gdk.ModifierType.SHIFT_MASK:
@@ -93,9 +264,248 @@ class DlnaCollectionPanel (xlgui.panel.collection.CollectionPanel, GObject.GObje
     def __del__ (self):
         logger.debug("DLNA Collection panel destroyed!")
 
+    def is_incremental (self):
+        """Whether the tree is currently shown in incremental mode."""
+        return self.__model is not None and self.model is self.__model
+
+    def load_tree (self, *args):
+        """Override the tree loading for incremental mode.
+
+        In incremental mode, the model is kept up-to-date by the event
+        handlers, so (re)loading the tree only needs to re-attach it."""
+        if self.__full_model is None:
+            self.__full_model = self.model
+
+        if self.keyword or not self.__is_indexed_order():
+            # The base track list is not re-sorted while the
+            # incremental tree is shown; bring it up-to-date first
+            if self.__stale and self.order is not None:
+                self.resort_tracks()
+            self.__stale = False
+
+            self.model = self.__full_model
+            return xlgui.panel.collection.CollectionPanel.load_tree(self, *args)
+
+        if self.__index is None:
+            self.rebuild_index()
+
+        self.model = self.__model
+        self.tree.set_model(self.__model)
+
+        # Same bookkeeping as the base class
+        self.order = self.get_order()
+        xl.settings.set_option('gui/collection_active_view', self.choice.get_active())
+        self.emit('collection-tree-loaded')
+
+    def __is_indexed_order (self):
+        """Whether the selected order is exactly the artist -> album ->
+        track layout that DlnaTrackIndex models."""
+        order = self.get_order()
+        return (len(order) == 3 and
+                list(order.get_search_tags(0)) == ['artist'] and
+                list(order.get_search_tags(1)) == ['album'] and
+                list(order.get_sort_tags(2)) == ['discnumber', 'tracknumber', 'title'])
+
+    def rebuild_index (self):
+        """Rebuilds the index and the incremental model from scratch."""
+        logger.debug("DLNA Collection panel: rebuilding index!")
+
+        self.__index = DlnaTrackIndex(self.collection.get_tracks())
+        self.__loaded = set()
+
+        model = Gtk.TreeStore(GdkPixbuf.Pixbuf, str, object)
+        for artist in self.__index.get_artists():
+            self.__append_node(model, None, DlnaTrackIndex.ARTIST, artist)
+
+        attached = self.is_incremental()
+
+        self.__model = model
+
+        if attached:
+            self.model = model
+            self.tree.set_model(model)
+
+    def __get_node_row (self, depth, key):
+        """Returns the model row for an index node. The search terms
+        column is left empty; _find_tracks() resolves rows through the
+        index instead."""
+        if depth == DlnaTrackIndex.TRACK:
+            return [self.title_image, key[-1], None]
+
+        image = self.artist_image if depth == DlnaTrackIndex.ARTIST else self.album_image
+
+        value = key[-1]
+        if value is None:
+            value = _('Unknown')
+
+        return [image, value, None]
+
+    def __append_node (self, model, parent, depth, key, position=-1):
+        """Inserts a node row; artist and album rows receive a
+        placeholder child until they are expanded."""
+        node = model.insert(parent, position, self.__get_node_row(depth, key))
+        if depth != DlnaTrackIndex.TRACK:
+            model.append(node, [None, None, None])
+        return node
+
+    def __insert_track (self, track):
+        """Indexes a track and inserts the affected row, if visible."""
+        depth = self.__index.add(track)
+        if depth is None:
+            return
+
+        keys = self.__index.get_entry(track.get_loc_for_io())
+        (artist, album, entry) = keys
+        path = self.__index.get_path(keys)
+
+        if depth == DlnaTrackIndex.ARTIST:
+            self.__append_node(self.__model, None, depth, artist, path[0])
+        elif depth == DlnaTrackIndex.ALBUM:
+            if artist in self.__loaded:
+                parent = self.__model.get_iter(path[:1])
+                self.__append_node(self.__model, parent, depth, album, path[1])
+        elif (artist, album) in self.__loaded:
+            parent = self.__model.get_iter(path[:2])
+            self.__append_node(self.__model, parent, depth, entry, path[2])
+
+    def __remove_location (self, location):
+        """Removes a location from the index and drops the affected row,
+        if visible."""
+        keys = self.__index.get_entry(location)
+        if keys is None:
+            return
+
+        (artist, album, entry) = keys
+        path = self.__index.get_path(keys)
+
+        depth = self.__index.remove(location)
+
+        if depth == DlnaTrackIndex.ARTIST:
+            self.__model.remove(self.__model.get_iter(path[:1]))
+            self.__loaded.discard(artist)
+            self.__loaded.discard((artist, album))
+        elif depth == DlnaTrackIndex.ALBUM:
+            if artist in self.__loaded:
+                self.__model.remove(self.__model.get_iter(path[:2]))
+            self.__loaded.discard((artist, album))
+        elif (artist, album) in self.__loaded:
+            self.__model.remove(self.__model.get_iter(path))
+
+    def on_tracks_added (self, type, collection, locations):
+        if self.__index is None:
+            return
+
+        # Large batches (e.g., the initial scan) are cheaper to sort
+        # in one go than to insert one-by-one
+        if len(locations) > len(self.__index):
+            self.rebuild_index()
+            return
+
+        for location in locations:
+            track = self.collection.get_track_by_loc(location)
+            if track is not None:
+                self.__insert_track(track)
+
+    def on_tracks_removed (self, type, collection, locations):
+        if self.__index is None:
+            return
+
+        for location in locations:
+            self.__remove_location(location)
+
+    def on_track_tags_changed (self, type, track, tags):
+        if self.__index is None:
+            return
+
+        # Move the track only if its position in the tree changed
+        location = track.get_loc_for_io()
+        keys = self.__index.get_entry(location)
+        if keys is None or keys == self.__index.get_keys(track):
+            return
+
+        self.__remove_location(location)
+        self.__insert_track(track)
+
+    def refresh_tracks_in_tree (self, *args):
+        """Override the full tree refresh; not needed in incremental mode."""
+        if self.is_incremental():
+            self.__stale = True
+        else:
+            xlgui.panel.collection.CollectionPanel.refresh_tracks_in_tree(self, *args)
+
+    def refresh_tags_in_tree (self, *args):
+        """Override the full tree refresh; not needed in incremental mode."""
+        if self.is_incremental():
+            self.__stale = True
+        else:
+            xlgui.panel.collection.CollectionPanel.refresh_tags_in_tree(self, *args)
+
+    def on_expanded (self, tree, iter, path):
+        """Override the expansion handler to populate child rows from the index."""
+        if not self.is_incremental():
+            return xlgui.panel.collection.CollectionPanel.on_expanded(self, tree, iter, path)
+
+        indices = path.get_indices()
+
+        artist = self.__index.get_artists()[indices[0]]
+        if len(indices) == 1:
+            (node, depth, children) = (artist, DlnaTrackIndex.ALBUM, self.__index.get_albums(artist))
+        else:
+            album = self.__index.get_albums(artist)[indices[1]]
+            (node, depth, children) = ((artist, album), DlnaTrackIndex.TRACK, self.__index.get_tracks(artist, album))
+
+        if node in self.__loaded:
+            return
+        self.__loaded.add(node)
+
+        placeholder = self.__model.iter_children(iter)
+        for key in children:
+            self.__append_node(self.__model, iter, depth, key)
+        self.__model.remove(placeholder)
+
+    def _find_tracks (self, iter):
+        """Override the track lookup to resolve rows through the index."""
+        if not self.is_incremental():
+            return xlgui.panel.collection.CollectionPanel._find_tracks(self, iter)
+
+        indices = self.__model.get_path(iter).get_indices()
+
+        tracks = []
+        for location in self.__get_path_locations(indices):
+            track = self.collection.get_track_by_loc(location)
+            if track is not None:
+                tracks.append(track)
+
+        return tracks
+
+    def __get_path_locations (self, indices):
+        """Returns the track locations under the given tree path."""
+        artists = self.__index.get_artists()
+        if indices[0] >= len(artists):
+            return []
+
+        artist = artists[indices[0]]
+        if len(indices) == 1:
+            return self.__index.get_locations(artist)
+
+        # Unpopulated node; only the placeholder row is there
+        if artist not in self.__loaded:
+            return []
+
+        album = self.__index.get_albums(artist)[indices[1]]
+        if len(indices) == 2:
+            return self.__index.get_locations(artist, album)
+
+        if (artist, album) not in self.__loaded:
+            return []
+
+        return [ self.__index.get_tracks(artist, album)[indices[2]][3] ]
+
 
 #class DlnaCollection (xl.collection.Collection):
 class DlnaCollection (xl.trax.TrackDB):
+    __FINGERPRINT_TAGS = ('artist', 'albumartist', 'composer', 'title', 'album', 'tracknumber', 'date', '__length')
+
     def __init__ (self, media_server):
         super(DlnaCollection, self).__init__(media_server.get_friendly_name())
 
@@ -105,6 +515,9 @@ class DlnaCollection (xl.trax.TrackDB):
         # expected by the xlgui.panel.collection.CollectionPanel
         self._scanning = False
 
+        # Server-provided metadata of the tracks, by location
+        self.__fingerprints = {}
+
         # Store reference to media server
         self.__media_server = media_server
 
@@ -139,16 +552,42 @@ class DlnaCollection (xl.trax.TrackDB):
         logger.debug("DLNA Collection: rescan media server")
         self.__media_server.rescan_audio_items()
 
+    def get_fingerprint (self, track):
+        """Returns the server-provided metadata of the track."""
+        return tuple(track.get_tag_raw(tag) for tag in self.__FINGERPRINT_TAGS)
+
     @xl.common.threaded
     def update_tracks (self, new_tracks):
         self._scanning = True
 
-        # Remove old tracks; this is a bit roundabout, but works...
-        old_tracks = self.get_tracks()
-        self.remove_tracks(old_tracks)
+        # The media server re-uses Track objects and updates their tags
+        # in place, so compare against the metadata recorded when the
+        # tracks were added to find the ones that changed
+        new_locations = set()
+        changed_tracks = []
+
+        for track in new_tracks:
+            location = track.get_loc_for_io()
+            new_locations.add(location)
+
+            fingerprint = self.__fingerprints.get(location)
+            if fingerprint is not None and fingerprint != self.get_fingerprint(track):
+                changed_tracks.append(track)
+
+        # Remove stale and changed tracks, then (re-)add the new and
+        # changed ones; this way, only the differences are announced
+        # via tracks_removed and tracks_added events
+        stale_tracks = [track for track in self.get_tracks() if track.get_loc_for_io() not in new_locations]
+        self.remove_tracks(stale_tracks + changed_tracks)
+
+        for track in stale_tracks:
+            self.__fingerprints.pop(track.get_loc_for_io(), None)
+
+        added_tracks = [track for track in new_tracks if not self.loc_is_member(track.get_loc_for_io())]
+        for track in added_tracks:
+            self.__fingerprints[track.get_loc_for_io()] = self.get_fingerprint(track)
 
-        # Add new tracks
-        self.add_tracks(new_tracks)
+        self.add_tracks(added_tracks)
 
         self._scanning = False
 